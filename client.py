@@ -1,5 +1,11 @@
+import collections
+import ctypes
+import errno
+import os
+import selectors
 import socket
 import struct
+import sys
 import threading
 import time
 
@@ -12,8 +18,23 @@ OFFER_MESSAGE_TYPE = 0x2
 REQUEST_MESSAGE_TYPE = 0x3
 PAYLOAD_MESSAGE_TYPE = 0x4
 
+# Precompiled packet layouts
+OFFER_HDR = struct.Struct('!IBHH')     # cookie, type, udp port, tcp port
+OFFER_PREFIX = struct.pack('!IB', OFFER_MAGIC_COOKIE, OFFER_MESSAGE_TYPE)
+REQUEST_HDR = struct.Struct('!IBQQ')   # cookie, type, file size, thread number
+PAYLOAD_HDR = struct.Struct('!IBQQQ')  # cookie, type, total segments, segment number, thread number
+TCP_REQUEST = struct.Struct('!Q')      # file size, the whole TCP request
+END_OF_TRANSFER_SEGMENT = 0xFFFFFFFFFFFFFFFF   # Segment number the server sends once it is done
+
 UDP_BROADCAST_PORT = 13117   # Where the client listens for broadcast offers
 
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024   # Kernel send/receive buffer per socket
+TCP_RECV_SLICE = 1024 * 1024           # Bytes each MSG_WAITALL receive waits for
+TCP_RECV_TIMEOUT = 10                  # Seconds a stalled TCP receive may block
+RECV_BATCH_SIZE = 64                   # Datagrams pulled per recvmmsg() call
+RECV_SLOT_SIZE = 2048                  # Bytes reserved for each datagram in a batch
+WORKER_STACK_SIZE = 512 * 1024         # Workers never recurse, the 8 MiB default is waste
+
 # For color
 GREEN = "\033[92m"
 YELLOW = "\033[93m"
@@ -24,10 +45,212 @@ RESET = "\033[0m"
 # Event to let us stop the client gracefully if needed
 client_shutdown_event = threading.Event()
 
+# =============================================================================
+#                        BATCHED RECEIVE (recvmmsg)
+# =============================================================================
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IoVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+# Kernel receive timestamps as a struct timespec in ancillary data (Linux only)
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)
+_TIMESPEC = struct.Struct('@ll')    # tv_sec, tv_nsec
+_CMSG_TIMESPEC = '@Niill'           # cmsg_len, cmsg_level, cmsg_type, then the timespec
+
+_libc = None
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint,
+                                   ctypes.c_int, ctypes.c_void_p]
+        _libc.recvmmsg.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        _libc = None
+
 # =============================================================================
 #                               CLIENT CODE
 # =============================================================================
 
+def _buffer_limit(name):
+    """
+    Reads a net.core buffer cap (rmem_max / wmem_max) in bytes, or None where it can't be read.
+    """
+    try:
+        with open(f"/proc/sys/net/core/{name}") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+# Caps on what an unprivileged SO_RCVBUF / SO_SNDBUF may request
+_RMEM_MAX = _buffer_limit("rmem_max")
+_WMEM_MAX = _buffer_limit("wmem_max")
+
+
+def _tune_sock(sock, size=SOCKET_BUFFER_SIZE):
+    """
+    Enlarges the kernel receive/send buffers so bursts are not dropped
+    and TCP can open a large window. Disables Nagle on TCP sockets.
+    A fixed buffer switches off TCP autotuning, so TCP sockets only get one
+    when the system cap lets it reach the full size; otherwise autotuning
+    (which can grow past the cap) is left in charge.
+    """
+    if sock.type == socket.SOCK_STREAM:
+        if _RMEM_MAX is not None and _RMEM_MAX >= size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+        if _WMEM_MAX is not None and _WMEM_MAX >= size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return
+
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+
+def _set_recv_timeout(sock, seconds):
+    """
+    Sets a kernel-level receive timeout (SO_RCVTIMEO) so a blocking socket
+    can wait inside one recv() call without hanging forever.
+    """
+    if sys.platform == "win32":
+        value = struct.pack('I', int(seconds * 1000))  # DWORD milliseconds
+    else:
+        value = struct.pack('ll', int(seconds), int(seconds % 1 * 1_000_000))  # struct timeval
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, value)
+
+
+def _make_batch_receiver(header, n=RECV_BATCH_SIZE, slot_size=RECV_SLOT_SIZE):
+    """
+    Returns recv_batch(sock), which reads up to n queued datagrams from a
+    non-blocking socket into one reused buffer and returns a list of
+    (length, arrival_ns, fields) tuples, fields being the datagram's leading
+    `header` struct. Headers are unpacked for the whole batch at once in C
+    (strided iter_unpack), callers must ignore fields when length < header.size.
+    Uses a single recvmmsg() call on Linux, a recv_into() loop elsewhere.
+    On Linux arrival_ns is the kernel's SO_TIMESTAMPNS stamp when the socket
+    has it enabled; otherwise the clock is read once per batch.
+    Raises BlockingIOError when nothing is queued.
+    """
+    backing = bytearray(n * slot_size)
+    view = memoryview(backing)
+    # One struct spanning a whole slot: iter_unpack then steps from header to header
+    slot_hdr = struct.Struct(f"{header.format}{slot_size - header.size}x")
+
+    if _libc is None:
+        def recv_batch(sock):
+            lengths = []
+            offset = 0
+            try:
+                while len(lengths) < n:
+                    lengths.append(sock.recv_into(view[offset:offset + slot_size]))
+                    offset += slot_size
+            except BlockingIOError:
+                if not lengths:
+                    raise
+            now = time.monotonic_ns()
+            return [(length, now, fields)
+                    for length, fields in zip(lengths, slot_hdr.iter_unpack(view[:offset]))]
+
+        return recv_batch
+
+    ctrl_size = socket.CMSG_SPACE(_TIMESPEC.size)
+    control = bytearray(n * ctrl_size)
+    base = ctypes.addressof((ctypes.c_char * len(backing)).from_buffer(backing))
+    ctrl_base = ctypes.addressof((ctypes.c_char * len(control)).from_buffer(control))
+    iovecs = (_IoVec * n)()
+    hdrs = (_MMsgHdr * n)()
+    for i in range(n):
+        iovecs[i].iov_base = base + i * slot_size
+        iovecs[i].iov_len = slot_size
+        hdrs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+        hdrs[i].msg_hdr.msg_iovlen = 1
+        hdrs[i].msg_hdr.msg_control = ctrl_base + i * ctrl_size
+        hdrs[i].msg_hdr.msg_controllen = ctrl_size
+    # The kernel rewrites msg_controllen on every call; restore all headers in one memmove
+    pristine = (_MMsgHdr * n)()
+    ctypes.memmove(pristine, hdrs, ctypes.sizeof(hdrs))
+
+    # Strided views over the mmsghdr array and the control buffers, like slot_hdr above
+    hdr_size = ctypes.sizeof(_MMsgHdr)
+    len_offset = _MMsgHdr.msg_len.offset
+    msg_len = struct.Struct(f"@{len_offset}xI{hdr_size - len_offset - 4}x")
+    cmsg = struct.Struct(f"{_CMSG_TIMESPEC}{ctrl_size - struct.calcsize(_CMSG_TIMESPEC)}x")
+    hdrs_view = memoryview(hdrs).cast('B')
+    ctrl_view = memoryview(control)
+
+    def recv_batch(sock):
+        while True:
+            ctypes.memmove(hdrs, pristine, hdr_size * n)
+            ctypes.memset(ctrl_base, 0, len(control))
+            count = _libc.recvmmsg(sock.fileno(), hdrs, n, socket.MSG_DONTWAIT, None)
+            if count >= 0:
+                # Same clock as the kernel stamps, used if a datagram carries none
+                now = time.time_ns()
+                return [(length,
+                         sec * 1_000_000_000 + nsec
+                         if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS else now,
+                         fields)
+                        for (length,), (_, level, kind, sec, nsec), fields in zip(
+                            msg_len.iter_unpack(hdrs_view[:count * hdr_size]),
+                            cmsg.iter_unpack(ctrl_view[:count * ctrl_size]),
+                            slot_hdr.iter_unpack(view[:count * slot_size]))]
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise BlockingIOError(err, os.strerror(err))
+            raise OSError(err, os.strerror(err))
+
+    # Keep the ctypes arrays alive as long as the closure is
+    recv_batch.buffers = (backing, control, iovecs, hdrs, pristine)
+    return recv_batch
+
+
+class _UdpFlow:
+    """
+    Receive-side state of one UDP transfer. Only the dispatcher thread writes
+    it; the worker that owns it waits on `done` and then reads the totals.
+    """
+    __slots__ = ("expected", "seen", "received", "last_arrival", "delta_sum", "progress", "done")
+
+    def __init__(self, expected, progress):
+        self.expected = expected
+        # One byte per expected segment marks which sequence numbers arrived
+        self.seen = bytearray(expected)
+        self.received = 0
+        self.last_arrival = 0
+        # Running sum of |gap| between consecutive arrivals (ns), for the mean-gap jitter figure
+        self.delta_sum = 0
+        self.progress = progress
+        self.done = threading.Event()
+
+
+def _discard_datagram(sock):
+    """
+    Drops the next queued datagram while copying at most one byte of it.
+    """
+    try:
+        sock.recv(1)
+    except OSError:
+        pass  # Windows reports the truncation (WSAEMSGSIZE) but still drops it
+
+
 def udp_discover():
     """
     Listens on UDP_BROADCAST_PORT (13117) for an offer.
@@ -37,171 +260,254 @@ def udp_discover():
     udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     # Allow re-use so multiple clients can bind the same port
     udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    _tune_sock(udp_socket)
     udp_socket.bind(("", UDP_BROADCAST_PORT))
+    udp_socket.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(udp_socket, selectors.EVENT_READ)
 
     print(f"{CYAN}Listening for server offers on UDP port {UDP_BROADCAST_PORT}...{RESET}")
 
     while not client_shutdown_event.is_set():
-        udp_socket.settimeout(3)  # Wait up to 3 seconds for broadcast
         try:
+            if not selector.select(timeout=3):  # Wait up to 3 seconds for broadcast
+                print(f"{YELLOW}No offers received yet... retrying.{RESET}")
+                continue
+
+            # Peek at the header first so noise on the broadcast port costs a 9-byte copy
+            try:
+                header, addr = udp_socket.recvfrom(OFFER_HDR.size, socket.MSG_PEEK)
+            except BlockingIOError:
+                raise
+            except OSError:
+                header = b""  # Windows fails a short peek at a longer datagram; offers never are
+            if not header.startswith(OFFER_PREFIX):
+                _discard_datagram(udp_socket)
+                continue
+
             data, addr = udp_socket.recvfrom(1024)
             print(f"Received raw data: {data} from {addr}")
 
-        except socket.timeout:
-            print(f"{YELLOW}No offers received yet... retrying.{RESET}")
+        except BlockingIOError:
             continue
         except KeyboardInterrupt:
             print(f"{RED}Client interrupted, shutting down...{RESET}")
             break
 
         try:
-            magic_cookie, msg_type, udp_port, tcp_port = struct.unpack('!IBHH', data)
+            magic_cookie, msg_type, udp_port, tcp_port = OFFER_HDR.unpack(data)
             print(
                 f"Parsed packet: magic_cookie={hex(magic_cookie)}, msg_type={msg_type}, udp_port={udp_port}, tcp_port={tcp_port}")
             if magic_cookie == OFFER_MAGIC_COOKIE and msg_type == OFFER_MESSAGE_TYPE:
                 print(f"{GREEN}Received offer from {addr[0]}:{RESET} UDP={udp_port}, TCP={tcp_port}")
+                selector.close()
                 udp_socket.close()
                 return addr[0], udp_port, tcp_port
         except Exception as e:
             print(f"{RED}Error parsing offer: {e}{RESET}")
 
+    selector.close()
     udp_socket.close()
     return None, None, None
 
-def print_progress(identifier, current, total):
+def format_progress(identifier, current, total):
     """
-    Shows a simple progress bar
+    Returns a simple progress bar line for one worker
     """
     bar_length = 20
-    fraction = current / total if total > 0 else 1
+    fraction = min(current / total, 1) if total > 0 else 1
     filled = int(bar_length * fraction)
     bar = '#' * filled + '-' * (bar_length - filled)
-    print(f"\r{CYAN}[{identifier}] [{bar}] {current}/{total}{RESET}", end='', flush=True)
+    return f"{CYAN}[{identifier}] [{bar}] {current}/{total}{RESET}"
 
 
 def perform_speed_test(server_ip, server_udp_port, server_tcp_port, file_size, tcp_connections, udp_connections):
+    # Each worker owns a deque(maxlen=1) in progress_dict and is its only writer;
+    # results and errors are queued in messages so only the renderer writes stdout
     progress_dict = {}
-    progress_lock = threading.Lock()
+    progress_totals = {}
+    messages = collections.deque()
+    render_done = threading.Event()
+
+    def render_progress():
+        """
+        Ten times a second prints any queued worker messages, then redraws one
+        progress bar line per worker in place (ANSI cursor-up), so the receive
+        loops never touch stdout.
+        """
+        drawn = 0
+        while True:
+            finished = render_done.wait(0.1)
+            lines = []
+            while messages:
+                lines.append(messages.popleft())
+            # Workers may still be registering; count the bars actually drawn in this frame,
+            # or the next cursor-up would climb too far and overwrite earlier output
+            bars = [format_progress(label, progress_dict[t_id][-1], total)
+                    for t_id, (label, total) in list(progress_totals.items())]
+            lines += bars
+            frame = f"\033[{drawn}F" if drawn else ""
+            frame += "".join(f"\033[2K{line}\n" for line in lines)
+            print(frame, end='', flush=True)
+            drawn = len(bars)
+            if finished:
+                return
+
+    # Every TCP worker sends the same request; encode it once
+    size_bytes = TCP_REQUEST.pack(file_size)
 
     def tcp_test(t_id):  # Parameter name updated to t_id
         retries = 3
+        progress = progress_dict[t_id]
+        # Receive straight into one preallocated buffer instead of growing a bytes object
+        data_buf = bytearray(file_size)
+        data_view = memoryview(data_buf)
         while retries > 0 and not client_shutdown_event.is_set():
             tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             start_time = time.time()
             bytes_received = 0
-            data_buf = b""
 
             try:
+                _tune_sock(tcp_socket)
                 tcp_socket.settimeout(10)
                 tcp_socket.connect((server_ip, server_tcp_port))
-                tcp_socket.sendall(f"{file_size}\n".encode())
+                tcp_socket.sendall(size_bytes)
 
-                chunk_size = 8192
-                while bytes_received < file_size:
-                    chunk = tcp_socket.recv(chunk_size)
-                    if not chunk:
-                        if bytes_received < file_size:
-                            raise ConnectionError("Connection closed prematurely")
-                        break
-                    data_buf += chunk
-                    bytes_received += len(chunk)
+                # Truly blocking socket: MSG_WAITALL makes the kernel fill a whole slice
+                # in one recv() call, SO_RCVTIMEO still bounds a stalled transfer
+                tcp_socket.settimeout(None)
+                _set_recv_timeout(tcp_socket, TCP_RECV_TIMEOUT)
 
-                    with progress_lock:
-                        progress_dict[t_id] = bytes_received
-                        print_progress(f"TCP-{t_id}", bytes_received, file_size)
+                while bytes_received < file_size:
+                    try:
+                        n = tcp_socket.recv_into(data_view[bytes_received:bytes_received + TCP_RECV_SLICE],
+                                                 0, socket.MSG_WAITALL)
+                    except BlockingIOError:
+                        raise socket.timeout("timed out waiting for data")
+                    if n == 0:
+                        raise ConnectionError("Connection closed prematurely")
+                    # A short read (timeout, signal) simply continues with the rest of the slice
+                    bytes_received += n
+                    progress.append(bytes_received)
 
                 total_time = time.time() - start_time
                 speed = bytes_received / total_time if total_time > 0 else 0
-                print(
-                    f"\n{GREEN}[TCP-{t_id}] Received {bytes_received} bytes in {total_time:.2f}s, speed={speed:.2f} B/s{RESET}")
+                messages.append(
+                    f"{GREEN}[TCP-{t_id}] Received {bytes_received} bytes in {total_time:.2f}s, speed={speed:.2f} B/s{RESET}")
                 return
 
             except Exception as e:
                 retries -= 1
                 if retries > 0:
                     time.sleep(1)
-                print(f"\n{RED}[TCP-{t_id}] Error: {e}, retries left: {retries}{RESET}")
+                messages.append(f"{RED}[TCP-{t_id}] Error: {e}, retries left: {retries}{RESET}")
             finally:
                 tcp_socket.close()
 
+    def udp_dispatch():
+        """
+        Drains the shared UDP socket and credits every payload datagram to the
+        flow whose thread number the server echoed back in the header.
+        Runs until dispatch_done is set.
+        """
+        recv_batch = _make_batch_receiver(PAYLOAD_HDR)
+        header_size = PAYLOAD_HDR.size
+        last_errno = None
+        while not dispatch_done.is_set():
+            if not udp_selector.select(timeout=0.1):
+                continue
+            try:
+                datagrams = recv_batch(shared_udp)
+            except (BlockingIOError, ConnectionRefusedError, ConnectionResetError):
+                # Refused/reset: an ICMP error from the server port (reset on Windows), the worker will retry
+                continue
+            except OSError as e:
+                # Every UDP flow depends on this thread, so report the error and keep receiving
+                if e.errno != last_errno:
+                    messages.append(f"{RED}[UDP] Receive error: {e}{RESET}")
+                    last_errno = e.errno
+                continue
+            last_errno = None
+
+            for length, arrival, (cookie, msg_type, total, seq, thread_num) in datagrams:
+                if length < header_size:
+                    continue
+                if cookie != OFFER_MAGIC_COOKIE or msg_type != PAYLOAD_MESSAGE_TYPE:
+                    continue
+
+                flow = flows.get(thread_num)
+                if flow is None:
+                    continue
+                if seq == END_OF_TRANSFER_SEGMENT:
+                    flow.done.set()
+                    continue
+
+                if seq < flow.expected and not flow.seen[seq]:
+                    flow.seen[seq] = 1
+                    if flow.received:
+                        flow.delta_sum += abs(arrival - flow.last_arrival)
+                    flow.received += 1
+                    flow.last_arrival = arrival
+                    if flow.received >= total:
+                        flow.done.set()
+
+            for flow in list(flows.values()):
+                flow.progress.append(flow.received)
+
     def udp_test(t_id):
         """
         Fixed UDP test client function
         """
         retries = 3
+        progress = progress_dict[t_id]
+        thread_num = int(t_id[1:])  # Extract number from thread ID
+
+        # The request never changes between retries, so pack it once
+        request_msg = REQUEST_HDR.pack(OFFER_MAGIC_COOKIE,
+                                       REQUEST_MESSAGE_TYPE,
+                                       file_size,
+                                       thread_num)
+
         while retries > 0 and not client_shutdown_event.is_set():
-            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             try:
-                # Set buffer size
-                udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
-                udp_socket.settimeout(1)  # Shorter timeout
-                thread_num = int(t_id[1:])  # Extract number from thread ID
-
-                # Fix packet format to match server
-                request_msg = struct.pack('!IBQQ',
-                                          OFFER_MAGIC_COOKIE,
-                                          REQUEST_MESSAGE_TYPE,
-                                          file_size,
-                                          thread_num)
+                # The dispatcher fills this in; we only wait for it to finish
+                flow = _UdpFlow(file_size // 1024, progress)
+                flows[thread_num] = flow
 
                 start_time = time.time()
-                udp_socket.sendto(request_msg, (server_ip, server_udp_port))
+                shared_udp.send(request_msg)
 
-                packets = {}
-                arrival_times = []
-                received_packets = 0
-                last_update_time = time.time()
                 no_data_count = 0
                 max_no_data = 5
-
-                while True:
-                    try:
-                        data, _ = udp_socket.recvfrom(2048)  # Increased buffer
-
-                        # Fixed struct format to match server's response
-                        header_size = struct.calcsize('!IBQQ')
-                        if len(data) < header_size:
-                            continue
-
-                        cookie, msg_type, total, seq = struct.unpack('!IBQQ', data[:header_size])
-
-                        if cookie != OFFER_MAGIC_COOKIE or msg_type != PAYLOAD_MESSAGE_TYPE:
-                            continue
-
-                        if seq not in packets:
-                            packets[seq] = True
-                            received_packets += 1
-                            arrival_times.append(time.time())
-                            no_data_count = 0
-
-                        if time.time() - last_update_time >= 0.1:
-                            with progress_lock:
-                                progress_dict[t_id] = received_packets
-                                expected_packets = file_size // 1024
-                                print_progress(f"UDP-{t_id}", received_packets, expected_packets)
-                            last_update_time = time.time()
-
-                        if received_packets >= total:
-                            break
-
-                    except socket.timeout:
-                        no_data_count += 1
-                        if no_data_count > max_no_data:
-                            break
+                last_count = 0
+                # Once data is flowing a 100ms silence means the stream is over; the
+                # end-of-transfer marker normally ends the wait before that
+                while not flow.done.wait(0.1 if flow.received else 1):
+                    if flow.received != last_count:
+                        last_count = flow.received
+                        no_data_count = 0
                         continue
+                    no_data_count += 1
+                    if no_data_count > max_no_data:
+                        break
 
                 total_time = time.time() - start_time
-                expected_packets = file_size // 1024
+                received_packets = flow.received
+                expected_packets = flow.expected
                 lost_packets = expected_packets - received_packets
 
+                # Mean |delta| between consecutive arrivals. The stamps are wall-clock
+                # (SO_TIMESTAMPNS is CLOCK_REALTIME) and may step, so sum each gap rather
+                # than using (last - first)
                 jitter = 0.0
-                if len(arrival_times) > 1:
-                    deltas = [abs(arrival_times[i] - arrival_times[i - 1]) for i in range(1, len(arrival_times))]
-                    jitter = sum(deltas) / len(deltas) if deltas else 0
+                if received_packets > 1:
+                    jitter = flow.delta_sum / (received_packets - 1) / 1e9
 
                 speed = (received_packets * 1024) / total_time if total_time > 0 else 0
 
-                print(f"\n{GREEN}[UDP-{t_id}] Received {received_packets}/{expected_packets} packets "
+                messages.append(f"{GREEN}[UDP-{t_id}] Received {received_packets}/{expected_packets} packets "
                       f"(loss={lost_packets}, jitter={jitter:.4f}s), speed={speed:.2f} B/s{RESET}")
                 return
 
@@ -209,33 +515,61 @@ def perform_speed_test(server_ip, server_udp_port, server_tcp_port, file_size, t
                 retries -= 1
                 if retries > 0:
                     time.sleep(1)
-                print(f"\n{RED}[UDP-{t_id}] Error: {e}, retries left: {retries}{RESET}")
-            finally:
-                try:
-                    udp_socket.close()
-                except:
-                    pass
-
+                messages.append(f"{RED}[UDP-{t_id}] Error: {e}, retries left: {retries}{RESET}")
+
+    renderer = threading.Thread(target=render_progress, daemon=True)
+    renderer.start()
+
+    # All UDP workers share one socket; a single dispatcher thread receives for all of them
+    flows = {}
+    dispatch_done = threading.Event()
+    if udp_connections:
+        shared_udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        _tune_sock(shared_udp)
+        # The server replies from the port it was asked on, so connect: sends need no
+        # address and the kernel drops datagrams from anyone else
+        shared_udp.connect((server_ip, server_udp_port))
+        if _libc is not None:
+            # Let the kernel stamp each datagram instead of reading the clock per packet
+            shared_udp.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        shared_udp.setblocking(False)
+        udp_selector = selectors.DefaultSelector()
+        udp_selector.register(shared_udp, selectors.EVENT_READ)
+        dispatcher = threading.Thread(target=udp_dispatch, daemon=True)
+        dispatcher.start()
+
+    # Small stacks and no start-up stagger: hundreds of workers start at once
+    previous_stack_size = threading.stack_size(WORKER_STACK_SIZE)
     threads = []
     for i in range(tcp_connections):
         t_id = f"T{i + 1}"
-        progress_dict[t_id] = 0
+        progress_dict[t_id] = collections.deque([0], maxlen=1)
+        progress_totals[t_id] = (f"TCP-{t_id}", file_size)
         t = threading.Thread(target=tcp_test, args=(t_id,))
         t.start()
         threads.append(t)
-        time.sleep(0.1)  # Stagger connection starts
 
     for i in range(udp_connections):
         t_id = f"U{i + 1}"
-        progress_dict[t_id] = 0
+        progress_dict[t_id] = collections.deque([0], maxlen=1)
+        progress_totals[t_id] = (f"UDP-{t_id}", file_size // 1024)
         t = threading.Thread(target=udp_test, args=(t_id,))
         t.start()
         threads.append(t)
-        time.sleep(0.1)  # Stagger connection starts
+    threading.stack_size(previous_stack_size)
 
     for t in threads:
         t.join()
 
+    if udp_connections:
+        dispatch_done.set()
+        dispatcher.join()
+        udp_selector.close()
+        shared_udp.close()
+
+    render_done.set()
+    renderer.join()
+
     print(f"{GREEN}All transfers completed!{RESET}")
 
 def main():
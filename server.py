@@ -1,34 +1,429 @@
+import ctypes
+import errno
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+import select
+import selectors
 import socket
 import struct
+import sys
+import tempfile
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 # =============================================================================
 #                               CONSTANTS
 # =============================================================================
-connection_lock = threading.Lock()
 OFFER_MAGIC_COOKIE = 0xabcddcba
 OFFER_MESSAGE_TYPE = 0x2
 REQUEST_MESSAGE_TYPE = 0x3
 PAYLOAD_MESSAGE_TYPE = 0x4
 
+# Precompiled packet layouts
+OFFER_HDR = struct.Struct('!IBHH')     # cookie, type, udp port, tcp port
+REQUEST_HDR = struct.Struct('!IBQQ')   # cookie, type, file size, thread number
+PAYLOAD_HDR = struct.Struct('!IBQQQ')  # cookie, type, total segments, segment number, thread number
+SEGMENT_FIELD = struct.Struct('!Q')    # PAYLOAD_HDR's segment number on its own, for patching in place
+SEGMENT_OFFSET = 13                    # Where that segment number starts within PAYLOAD_HDR
+TCP_REQUEST = struct.Struct('!Q')      # file size, the whole TCP request
+_SOCKADDR_PORT = struct.Struct('!H')   # Port field of a struct sockaddr_in (at offset 2)
+
 UDP_BROADCAST_PORT = 13117   # Where the server sends broadcast offers
+BROADCAST_ADDRESS = '172.20.10.15'   # Destination of the offers (set to your network's broadcast address)
 UDP_SERVER_PORT = 20001      # Where the server listens for UDP requests
 TCP_SERVER_PORT = 20002      # Where the server listens for TCP connections
 
+END_OF_TRANSFER_SEGMENT = 0xFFFFFFFFFFFFFFFF   # Segment number marking the end of a UDP stream
+END_OF_TRANSFER_REPEAT = 3                     # Copies of the marker sent, in case one is lost
+
+SEGMENT_SIZE = 1024        # Bytes per UDP payload datagram
+SEND_BATCH_SIZE = 64       # Datagrams handed to the kernel per sendmmsg() call
+REQUEST_BATCH_SIZE = 32    # Requests pulled from the listener per recvmmsg() call
+REQUEST_SLOT_SIZE = 2048   # Receive buffer per request datagram
+GSO_SEGMENTS = 63          # Datagrams per GSO send; 63 x 1 KiB stays under the 64 KiB UDP limit
+GSO_MESSAGES = 8           # GSO sends submitted per sendmmsg() call (504 datagrams per syscall)
+FILLER_SIZE = 1 << 20      # Bytes of TCP payload per sendfile() call
+SENDFILE_THRESHOLD = 128 * 1024  # Smaller TCP transfers are sent with sendall(); sendfile() setup costs more than the copy
+SOCKET_BUFFER_SIZE = 7 << 20   # Kernel send/receive buffer for data sockets
+TCP_POOL_SIZE = 256        # Max TCP transfers served at once
+UDP_POOL_SIZE = 64         # Max UDP transfers served at once
+WORKER_STACK_SIZE = 512 * 1024   # Per-thread stack; handlers recurse shallowly, so the 8 MiB default is waste
+
+# CPUs the process may run on, so pool threads spawned from a pinned listener can be unpinned
+_ALL_CPUS = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else None
+
+# One listening socket per usable CPU on the same port; the kernel spreads clients across them.
+# The affinity mask, not os.cpu_count(), so a container limited to 2 of 64 cores starts 2.
+# Without SO_REUSEPORT (e.g. Windows) a second bind would fail, so fall back to one.
+if not hasattr(socket, "SO_REUSEPORT"):
+    LISTENER_COUNT = 1
+elif _ALL_CPUS is not None:
+    LISTENER_COUNT = len(_ALL_CPUS)
+else:
+    LISTENER_COUNT = os.cpu_count() or 1
+
+# Linux-only variants of SO_SNDBUF/SO_RCVBUF that ignore net.core.wmem_max/rmem_max (need CAP_NET_ADMIN)
+SO_SNDBUFFORCE = getattr(socket, "SO_SNDBUFFORCE", 32) if sys.platform.startswith("linux") else None
+SO_RCVBUFFORCE = getattr(socket, "SO_RCVBUFFORCE", 33) if sys.platform.startswith("linux") else None
+
+# UDP generic segmentation offload (Linux 4.18+): the kernel splits one large send into datagrams
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+
 # Event to signal the server threads to shut down gracefully
 server_shutdown_event = threading.Event()
 
+# Listeners also watch the read end, so one byte on the write end wakes them all at shutdown.
+# A socketpair rather than os.pipe() so select() works on Windows too.
+_wakeup_r, _wakeup_w = socket.socketpair()
+
+def _unpin_thread():
+    """
+    Lets a pool thread run on any CPU again (it inherits the affinity of the listener that spawned it).
+    """
+    if _ALL_CPUS is not None:
+        os.sched_setaffinity(0, _ALL_CPUS)
+
+
+# Numbers TCP connections for the log; next() on a count is atomic under the GIL, so no lock
+_tcp_connection_ids = itertools.count(1)
+
+# TCP connections being served; stop_server() shuts them down so blocked handlers return at once.
+# Pool workers are joined at interpreter exit, so a handler stuck sending would otherwise hold it.
+_open_tcp_connections = set()
+
+# Reused worker threads for client handlers; extra requests queue until a worker frees up
+TCP_POOL = ThreadPoolExecutor(max_workers=TCP_POOL_SIZE, thread_name_prefix="tcp", initializer=_unpin_thread)
+UDP_POOL = ThreadPoolExecutor(max_workers=UDP_POOL_SIZE, thread_name_prefix="udp", initializer=_unpin_thread)
+
 # For colorful printing
 GREEN = "\033[92m"
 YELLOW = "\033[93m"
 RED = "\033[91m"
 RESET = "\033[0m"
 
+# Handlers only enqueue records; a background listener thread formats and writes them,
+# so client threads never wait on the stdout lock or a write() syscall
+log = logging.getLogger("server")
+log.setLevel(logging.INFO)
+log.propagate = False
+_log_queue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+
+# Payload filler, built once; bytes are immutable, so every thread can send slices of the same view
+_FILLER = b'A' * FILLER_SIZE
+_FILLER_VIEW = memoryview(_FILLER)
+
+
+def _make_filler_file(size=FILLER_SIZE):
+    """
+    Creates a file of 'A' bytes for the TCP handler to sendfile() from.
+    Memory-backed where the OS supports it, so no disk is involved.
+    """
+    if hasattr(os, "memfd_create"):
+        filler = open(os.memfd_create("filler"), "w+b")
+    else:
+        filler = tempfile.TemporaryFile()
+    filler.write(_FILLER_VIEW[:size])
+    filler.flush()
+    return filler
+
+
+# Shared by all TCP handlers; sendfile() reads it at explicit offsets, so no locking is needed
+_FILLER_FILE = _make_filler_file()
+
+# =============================================================================
+#                  BATCHED SEND/RECEIVE (sendmmsg/recvmmsg)
+# =============================================================================
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IoVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+_libc = None
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+        _libc.sendmmsg.restype = ctypes.c_int
+        _libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint,
+                                   ctypes.c_int, ctypes.c_void_p]
+        _libc.recvmmsg.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        _libc = None
+
+
+def _probe_gso():
+    """
+    Reports whether this kernel understands UDP_SEGMENT (Linux 4.18+), tried on a
+    throwaway socket. Whether a given route can use it is only known at send time.
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.setsockopt(SOL_UDP, UDP_SEGMENT, SEGMENT_SIZE)
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
+
+
+_GSO_SUPPORTED = _probe_gso()
+
+# GSO is requested per send as ancillary data, never as a socket option on the shared
+# listener, so a transfer whose route can't segment can still fall back to plain sends
+_GSO_ANCDATA = [(SOL_UDP, UDP_SEGMENT, struct.pack('@H', SEGMENT_SIZE))]
+# The same cmsg as raw bytes for sendmmsg: cmsghdr (len, level, type), the u16, then padding
+_GSO_CMSG = (struct.pack('@Nii', socket.CMSG_LEN(2), SOL_UDP, UDP_SEGMENT) + struct.pack('@H', SEGMENT_SIZE)
+             ).ljust(socket.CMSG_SPACE(2), b'\0') if hasattr(socket, "CMSG_SPACE") else None
+
+# Send errors meaning this route can't do GSO: no checksum offload / xfrm (EIO), path MTU too small (EINVAL)
+_GSO_ROUTE_ERRORS = (errno.EIO, errno.EINVAL)
+
+
+def _wait_writable(sock, timeout=1.0):
+    """
+    Blocks until a non-blocking socket has send-buffer space again, shutdown is
+    signalled, or timeout elapses. This is the only pacing on the UDP send path:
+    senders go exactly as fast as the kernel drains the buffer.
+    """
+    if hasattr(select, "poll"):
+        # poll() has no FD_SETSIZE limit, which select() hits once fds pass 1024
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT)
+        poller.register(_wakeup_r, select.POLLIN)
+        poller.poll(timeout * 1000)
+    else:
+        select.select([_wakeup_r], [sock], [], timeout)
+
+
+def _sendto(sock, data, addr, ancdata=None):
+    """
+    sendto() on a non-blocking socket, waiting for buffer space instead of failing with EAGAIN.
+    With ancdata it goes through sendmsg() to carry the control messages.
+    Returns 0 without sending if the server is shutting down.
+    """
+    while True:
+        try:
+            if ancdata is not None:
+                return sock.sendmsg([data], ancdata, 0, addr)
+            return sock.sendto(data, addr)
+        except BlockingIOError:
+            if server_shutdown_event.is_set():
+                return 0
+            _wait_writable(sock)
+
+
+def _make_batch_sender(addr, n=SEND_BATCH_SIZE, slot_size=SEGMENT_SIZE, control=None):
+    """
+    Preallocates n datagram slots and their mmsghdr array, all addressed to the IPv4 addr
+    and all carrying the raw cmsg bytes in control, if given.
+    Returns (view, send_batch): fill view, then send_batch(sock, count, tail_len=None) sends the
+    first count slots (the last one cut to tail_len bytes if given) and returns how many went out,
+    waiting for buffer space if the socket is non-blocking (it stops early only at shutdown).
+    """
+    buf = ctypes.create_string_buffer(n * slot_size)
+    # struct sockaddr_in: family in host order, then port and address in network order, zero padded
+    name = ctypes.create_string_buffer(struct.pack('=H', socket.AF_INET) + _SOCKADDR_PORT.pack(addr[1])
+                                       + socket.inet_aton(addr[0]), 16)
+    # Only read by the kernel on send, so every message can point at the same copy
+    control_buf = ctypes.create_string_buffer(control, len(control)) if control else None
+    iovecs = (_IoVec * n)()
+    msgs = (_MMsgHdr * n)()
+    base = ctypes.addressof(buf)
+    for i in range(n):
+        iovecs[i].iov_base = base + i * slot_size
+        iovecs[i].iov_len = slot_size
+        msgs[i].msg_hdr.msg_name = ctypes.addressof(name)
+        msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(name)
+        if control_buf is not None:
+            msgs[i].msg_hdr.msg_control = ctypes.addressof(control_buf)
+            msgs[i].msg_hdr.msg_controllen = len(control)
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+    msg_size = ctypes.sizeof(_MMsgHdr)
+
+    def send_batch(sock, count, tail_len=None):
+        if tail_len is not None:
+            iovecs[count - 1].iov_len = tail_len
+        try:
+            return _send(sock.fileno(), sock, count)
+        finally:
+            if tail_len is not None:
+                iovecs[count - 1].iov_len = slot_size
+
+    def _send(fd, sock, count):
+        sent = 0
+        while sent < count:
+            # The kernel may accept only part of the batch; resume from the first unsent slot
+            first = ctypes.cast(ctypes.addressof(msgs) + sent * msg_size, ctypes.POINTER(_MMsgHdr))
+            n_sent = _libc.sendmmsg(fd, first, count - sent, 0)
+            if n_sent < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    if server_shutdown_event.is_set():
+                        break
+                    _wait_writable(sock)
+                    continue
+                if err == errno.EINTR:
+                    continue
+                raise OSError(err, os.strerror(err))
+            sent += n_sent
+        return sent
+
+    # Keeps the address and control buffers alive as long as the mmsghdrs pointing at them
+    send_batch.name = name
+    send_batch.control = control_buf
+    return memoryview(buf).cast('B')[:n * slot_size], send_batch
+
+
+def _make_batch_receiver(n=REQUEST_BATCH_SIZE, slot_size=REQUEST_SLOT_SIZE):
+    """
+    Preallocates n datagram slots with room for each sender's address.
+    Returns recv_batch(sock), which reads up to n datagrams from a non-blocking IPv4 socket
+    in one recvmmsg() call as a list of (data, addr), raising BlockingIOError if none are queued.
+    """
+    name_size = 16  # sizeof(struct sockaddr_in)
+    buf = ctypes.create_string_buffer(n * slot_size)
+    names = ctypes.create_string_buffer(n * name_size)
+    iovecs = (_IoVec * n)()
+    msgs = (_MMsgHdr * n)()
+    base = ctypes.addressof(buf)
+    names_base = ctypes.addressof(names)
+    for i in range(n):
+        iovecs[i].iov_base = base + i * slot_size
+        iovecs[i].iov_len = slot_size
+        msgs[i].msg_hdr.msg_name = names_base + i * name_size
+        msgs[i].msg_hdr.msg_namelen = name_size
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+    view = memoryview(buf).cast('B')
+    names_view = memoryview(names).cast('B')
+
+    def recv_batch(sock):
+        count = _libc.recvmmsg(sock.fileno(), msgs, n, 0, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise BlockingIOError(err, os.strerror(err))
+            raise OSError(err, os.strerror(err))
+
+        batch = []
+        for i in range(count):
+            offset = i * name_size
+            addr = (socket.inet_ntoa(names_view[offset + 4:offset + 8]),
+                    _SOCKADDR_PORT.unpack_from(names_view, offset + 2)[0])
+            batch.append((bytes(view[i * slot_size:i * slot_size + msgs[i].msg_len]), addr))
+            msgs[i].msg_hdr.msg_namelen = name_size  # The kernel overwrote it with the actual length
+        return batch
+
+    return recv_batch
+
 # =============================================================================
 #                               SERVER CODE
 # =============================================================================
 
+def stop_server():
+    """
+    Signals all server threads to shut down, wakes the listeners blocked in select(),
+    and shuts down open TCP connections so their handlers' sends fail immediately.
+    """
+    server_shutdown_event.set()
+    try:
+        _wakeup_w.send(b'x')
+    except OSError:
+        pass  # Already woken; the byte is never read
+
+    for conn in list(_open_tcp_connections):
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # Already closed by its handler
+
+
+def _open_listener(sock_type, port, index):
+    """
+    Creates listener number 'index' for a port, pinning the calling thread to a matching CPU.
+    Sockets share the port through SO_REUSEPORT when more than one listener runs.
+    """
+    if _ALL_CPUS is not None and LISTENER_COUNT > 1:
+        cpus = sorted(_ALL_CPUS)
+        os.sched_setaffinity(0, {cpus[index % len(cpus)]})
+
+    sock = socket.socket(socket.AF_INET, sock_type)
+    if LISTENER_COUNT > 1:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    return sock
+
+
+def _run_listeners(loop):
+    """
+    Runs LISTENER_COUNT copies of an accept/receive loop and waits for them all to exit.
+    """
+    threads = [threading.Thread(target=loop, args=(i,), daemon=True) for i in range(LISTENER_COUNT)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def _listen_selector(sock):
+    """
+    Puts a listening socket in non-blocking mode and returns a selector
+    that waits on it and on the shutdown wake-up socket.
+    """
+    sock.setblocking(False)
+    sel = selectors.DefaultSelector()
+    sel.register(sock, selectors.EVENT_READ)
+    sel.register(_wakeup_r, selectors.EVENT_READ)
+    return sel
+
+
+def _tune_sock(sock, size=SOCKET_BUFFER_SIZE):
+    """
+    Enlarges the kernel send/receive buffers so TCP can open a large window
+    and UDP bursts are not dropped. Tries the uncapped FORCE options first.
+    Disables Nagle on TCP sockets.
+    Without the FORCE options a TCP socket keeps its defaults: the capped
+    SO_SNDBUF/SO_RCVBUF would lock a small buffer and switch off autotuning.
+    """
+    stream = sock.type == socket.SOCK_STREAM
+    for force_opt, opt in ((SO_SNDBUFFORCE, socket.SO_SNDBUF), (SO_RCVBUFFORCE, socket.SO_RCVBUF)):
+        if force_opt is not None:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, force_opt, size)
+                continue
+            except OSError:
+                pass  # Not privileged; fall back to the capped option
+        if not stream:
+            sock.setsockopt(socket.SOL_SOCKET, opt, size)
+    if stream:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
 def udp_offer_broadcast():
     """
     Broadcasts offer messages over UDP until 'server_shutdown_event' is set.
@@ -37,164 +432,332 @@ def udp_offer_broadcast():
     # Enable broadcast
     udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
 
-    offer_message = struct.pack('!IBHH',
-                                OFFER_MAGIC_COOKIE,
-                                OFFER_MESSAGE_TYPE,
-                                UDP_SERVER_PORT,
-                                TCP_SERVER_PORT)
+    offer_message = OFFER_HDR.pack(OFFER_MAGIC_COOKIE,
+                                   OFFER_MESSAGE_TYPE,
+                                   UDP_SERVER_PORT,
+                                   TCP_SERVER_PORT)
 
     try:
+        connected = False
+        last_errno = None
         while not server_shutdown_event.is_set():
-            udp_socket.sendto(offer_message, ('172.20.10.15', UDP_BROADCAST_PORT))
-            time.sleep(1)
+            # connect() fails while there is no route yet (e.g. the hotspot is still coming up),
+            # and a connected socket reports ICMP errors from earlier offers on send(); none of
+            # that should stop the broadcast, so log each new error and retry next second
+            try:
+                if not connected:
+                    # Resolve and route the destination once; each offer is then a plain send()
+                    udp_socket.connect((BROADCAST_ADDRESS, UDP_BROADCAST_PORT))
+                    connected = True
+                udp_socket.send(offer_message)
+                last_errno = None
+            except OSError as e:
+                if e.errno != last_errno:
+                    log.warning(f"{YELLOW}[Broadcast] Could not send offer to {BROADCAST_ADDRESS}: {e}{RESET}")
+                    last_errno = e.errno
+            # Returns as soon as shutdown is signalled instead of finishing the second
+            server_shutdown_event.wait(1.0)
     finally:
         udp_socket.close()
 
 
 def handle_client_tcp(conn, addr):
-    with connection_lock:  # Add connection_lock = threading.Lock() at top of file
-        current_conn = threading.active_count()
+    conn_id = next(_tcp_connection_ids)
+    _open_tcp_connections.add(conn)
 
     try:
-        conn.settimeout(30)
-        raw_data = conn.recv(1024)
-        if not raw_data:
-            print(f"{RED}[TCP] Received no data from {addr}, closing.{RESET}")
-            return
-
-        file_size_str = raw_data.decode(errors='ignore').strip()
-        if not file_size_str.isdigit():
-            print(f"{RED}[TCP] Invalid file size from {addr}: '{file_size_str}'{RESET}")
+        # Registered too late for stop_server() to see it
+        if server_shutdown_event.is_set():
             return
 
-        file_size = int(file_size_str)
-        print(f"{GREEN}[TCP] {addr} requested {file_size} bytes.{RESET}")
-
-        chunk_size = 8192
+        conn.settimeout(30)
+        _tune_sock(conn)
+
+        # Read exactly the fixed-size request, however the client's bytes were split into segments
+        raw_data = bytearray(TCP_REQUEST.size)
+        received = 0
+        while received < TCP_REQUEST.size:
+            n = conn.recv_into(memoryview(raw_data)[received:])
+            if not n:
+                log.warning(f"{RED}[TCP] Incomplete request ({received}/{TCP_REQUEST.size} bytes) from {addr}, closing.{RESET}")
+                return
+            received += n
+
+        (file_size,) = TCP_REQUEST.unpack(raw_data)
+        log.info(f"{GREEN}[TCP] {addr} requested {file_size} bytes (connection #{conn_id}).{RESET}")
+
+        # Corked, the kernel only emits full-sized segments, even where one sendfile() call ends
+        # and the next begins (Linux only; elsewhere TCP_NODELAY alone applies)
+        tcp_cork = getattr(socket, "TCP_CORK", None)
+        if tcp_cork is not None:
+            conn.setsockopt(socket.IPPROTO_TCP, tcp_cork, 1)
+
+        # sendfile() moves the filler into the socket inside the kernel; without it, or for a
+        # transfer too small to repay its setup, send slices of the shared filler.
+        # Either way no bytes are built per chunk
+        use_sendfile = hasattr(os, "sendfile") and file_size >= SENDFILE_THRESHOLD
         bytes_sent = 0
         while bytes_sent < file_size and not server_shutdown_event.is_set():
-            remaining = file_size - bytes_sent
-            chunk = min(chunk_size, remaining)
-            conn.sendall(b'A' * chunk)
-            bytes_sent += chunk
+            chunk = min(FILLER_SIZE, file_size - bytes_sent)
+            if use_sendfile:
+                bytes_sent += conn.sendfile(_FILLER_FILE, 0, chunk)
+            else:
+                conn.sendall(_FILLER_VIEW[:chunk])
+                bytes_sent += chunk
+
+        if tcp_cork is not None:
+            conn.setsockopt(socket.IPPROTO_TCP, tcp_cork, 0)  # Flush the final partial segment now
 
-        print(f"{GREEN}[TCP] Finished sending {bytes_sent} bytes to {addr}.{RESET}")
+        log.info(f"{GREEN}[TCP] Finished sending {bytes_sent} bytes to {addr}.{RESET}")
 
     except Exception as e:
-        print(f"{RED}[TCP Error] with {addr}: {e}{RESET}")
+        if not server_shutdown_event.is_set():
+            log.error(f"{RED}[TCP Error] with {addr}: {e}{RESET}")
     finally:
+        _open_tcp_connections.discard(conn)
         conn.close()
 
 
 def tcp_server():
     """
     Listens for incoming TCP connections on 'TCP_SERVER_PORT'.
-    Spawns a new thread to handle each client.
+    Runs one accept loop per CPU, each on its own SO_REUSEPORT socket.
     """
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    _run_listeners(_tcp_accept_loop)
+
+
+def _tcp_accept_loop(index):
+    """
+    Accepts connections on one listening socket and hands each client to the TCP worker pool.
+    """
+    server_socket = _open_listener(socket.SOCK_STREAM, TCP_SERVER_PORT, index)
 
     try:
         server_socket.bind(("", TCP_SERVER_PORT))
         server_socket.listen(1000)
-        server_socket.settimeout(1)
-        print(f"{YELLOW}TCP Server started, listening on port {TCP_SERVER_PORT}{RESET}")
+        sel = _listen_selector(server_socket)
+        if index == 0:
+            log.info(f"{YELLOW}TCP Server started, listening on port {TCP_SERVER_PORT} ({LISTENER_COUNT} listeners){RESET}")
 
+        # Sleep until a client connects or stop_server() is called; no periodic wake-ups
         while not server_shutdown_event.is_set():
-            try:
-                conn, addr = server_socket.accept()
-            except socket.timeout:
-                continue
-
-            threading.Thread(
-                target=handle_client_tcp,
-                args=(conn, addr),
-                daemon=True
-            ).start()
+            sel.select()
+            while not server_shutdown_event.is_set():
+                try:
+                    conn, addr = server_socket.accept()
+                except BlockingIOError:
+                    break
+                try:
+                    TCP_POOL.submit(handle_client_tcp, conn, addr)
+                except RuntimeError:
+                    # The pool was shut down after the check above; nobody will serve this client
+                    conn.close()
+                    break
 
     except OSError as e:
-        print(f"{RED}[TCP] Could not bind on port {TCP_SERVER_PORT}: {e}{RESET}")
+        log.error(f"{RED}[TCP] Could not bind on port {TCP_SERVER_PORT}: {e}{RESET}")
     finally:
         server_socket.close()
 
 
-def handle_client_udp(data, addr, udp_socket):
+def _prefill_headers(view, slots, total_segments, thread_id):
     """
-    Fixed UDP handler with proper socket management and error handling
+    Writes a full payload header into each of the first 'slots' datagram slots of view,
+    echoing the client's thread number so it can demux flows sharing one socket.
+    Between batches only the segment numbers change, via SEGMENT_FIELD.
     """
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for i in range(slots):
+        PAYLOAD_HDR.pack_into(view, i * SEGMENT_SIZE,
+                              OFFER_MAGIC_COOKIE,
+                              PAYLOAD_MESSAGE_TYPE,
+                              total_segments,
+                              0,
+                              thread_id)
 
-    try:
-        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
-        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
 
-        # Changed format to match client (!IBQQ)
-        magic_cookie, msg_type, file_size, thread_id = struct.unpack('!IBQQ', data)
-        if magic_cookie != OFFER_MAGIC_COOKIE or msg_type != REQUEST_MESSAGE_TYPE:
-            return
+def _send_gso(udp_socket, addr, total_segments, thread_id):
+    """
+    Sends the payload as GSO messages of up to 63 concatenated datagrams that the kernel
+    (or NIC) splits; with sendmmsg, GSO_MESSAGES of those go out in one syscall.
+    Returns the segments sent, or None if the first send shows this route can't do GSO.
+    """
+    message_size = GSO_SEGMENTS * SEGMENT_SIZE
+    if _libc is not None and _GSO_CMSG is not None:
+        view, send_batch = _make_batch_sender(addr, GSO_MESSAGES, message_size, _GSO_CMSG)
+        view[:] = _FILLER_VIEW[:len(view)]
+    else:
+        view, send_batch = memoryview(bytearray(_FILLER_VIEW[:message_size])), None
+    per_call = len(view) // SEGMENT_SIZE
+    _prefill_headers(view, per_call, total_segments, thread_id)
+    pack_segment = SEGMENT_FIELD.pack_into
+    segment_offsets = range(SEGMENT_OFFSET, len(view), SEGMENT_SIZE)
+    sent_segments = 0
+
+    for start in range(0, total_segments, per_call):
+        if server_shutdown_event.is_set():
+            break
+
+        count = min(per_call, total_segments - start)
+        for offset, segment in zip(segment_offsets, range(start, start + count)):
+            pack_segment(view, offset, segment)
+        try:
+            if send_batch is not None:
+                messages = -(-count // GSO_SEGMENTS)
+                tail_len = (count - (messages - 1) * GSO_SEGMENTS) * SEGMENT_SIZE
+                sent_messages = send_batch(udp_socket, messages, tail_len)
+                sent_segments += min(count, sent_messages * GSO_SEGMENTS)
+            else:
+                _sendto(udp_socket, view[:count * SEGMENT_SIZE], addr, _GSO_ANCDATA)
+                sent_segments += count
+        except OSError as e:
+            if start == 0 and e.errno in _GSO_ROUTE_ERRORS:
+                return None
+            log.debug("[UDP] Error sending to %s, segments %d-%d/%d: %s", addr, start, start + count - 1, total_segments, e)
+            server_shutdown_event.wait(0.05)
+
+    return sent_segments
+
+
+def _send_batched(udp_socket, addr, total_segments, thread_id):
+    """
+    Sends the payload SEND_BATCH_SIZE datagrams per sendmmsg() call. Returns the segments sent.
+    """
+    view, send_batch = _make_batch_sender(addr)
+    view[:] = _FILLER_VIEW[:len(view)]
+    _prefill_headers(view, SEND_BATCH_SIZE, total_segments, thread_id)
+    pack_segment = SEGMENT_FIELD.pack_into
+    segment_offsets = range(SEGMENT_OFFSET, SEND_BATCH_SIZE * SEGMENT_SIZE, SEGMENT_SIZE)
+    sent_segments = 0
+
+    for start in range(0, total_segments, SEND_BATCH_SIZE):
+        if server_shutdown_event.is_set():
+            break
+
+        count = min(SEND_BATCH_SIZE, total_segments - start)
+        for offset, segment in zip(segment_offsets, range(start, start + count)):
+            pack_segment(view, offset, segment)
+        try:
+            sent_segments += send_batch(udp_socket, count)
+        except OSError as e:
+            log.debug("[UDP] Error sending to %s, segments %d-%d/%d: %s", addr, start, start + count - 1, total_segments, e)
+            server_shutdown_event.wait(0.05)
+
+    return sent_segments
+
+
+def _send_one_by_one(udp_socket, addr, total_segments, thread_id):
+    """
+    Sends the payload one sendto() per datagram. Returns the segments sent.
+    """
+    # Only the segment number changes between datagrams, so patch it in place
+    payload = bytearray(_FILLER_VIEW[:SEGMENT_SIZE])
+    _prefill_headers(payload, 1, total_segments, thread_id)
+    sent_segments = 0
 
-        print(f"{GREEN}[UDP] {addr} requested {file_size} bytes (thread {thread_id}).{RESET}")
-        total_segments = file_size // 1024
-        sent_segments = 0
+    for segment in range(total_segments):
+        if server_shutdown_event.is_set():
+            break
 
-        client_socket.settimeout(30)
+        try:
+            SEGMENT_FIELD.pack_into(payload, SEGMENT_OFFSET, segment)
+            _sendto(udp_socket, payload, addr)
+            sent_segments += 1
 
-        for segment in range(total_segments):
-            if server_shutdown_event.is_set():
-                break
+        except OSError as e:
+            log.debug("[UDP] Error sending to %s, segment %d/%d: %s", addr, segment, total_segments, e)
+            server_shutdown_event.wait(0.05)
 
-            try:
-                # Changed format to match client (!IBQQ)
-                payload = struct.pack('!IBQQ',
-                                    OFFER_MAGIC_COOKIE,
-                                    PAYLOAD_MESSAGE_TYPE,
-                                    total_segments,
-                                    segment)
-                payload += b'A' * (1024 - len(payload))
-
-                client_socket.sendto(payload, addr)
-                sent_segments += 1
-
-                if sent_segments % 50 == 0:
-                    time.sleep(0.01)
-
-            except (socket.error, socket.timeout) as e:
-                print(f"{RED}[UDP] Error sending to {addr}, segment {segment}/{total_segments}: {e}{RESET}")
-                time.sleep(0.05)
-                continue
+    return sent_segments
 
-        print(f"{GREEN}[UDP] Finished sending {sent_segments}/{total_segments} segments to {addr}.{RESET}")
+
+def handle_client_udp(data, addr, udp_socket):
+    """
+    Streams the requested payload back from the listener socket that received the request,
+    so replies come from the server's well-known port. That socket is shared and
+    non-blocking, so every send waits for buffer space rather than failing with EAGAIN.
+    Uses GSO where the route allows it, else sendmmsg batches, else one sendto() per datagram.
+    """
+    try:
+        # Same layout as the client's REQUEST_HDR
+        magic_cookie, msg_type, file_size, thread_id = REQUEST_HDR.unpack(data)
+        if magic_cookie != OFFER_MAGIC_COOKIE or msg_type != REQUEST_MESSAGE_TYPE:
+            return
+
+        log.info(f"{GREEN}[UDP] {addr} requested {file_size} bytes (thread {thread_id}).{RESET}")
+        total_segments = file_size // SEGMENT_SIZE
+
+        sent_segments = None
+        if _GSO_SUPPORTED:
+            sent_segments = _send_gso(udp_socket, addr, total_segments, thread_id)
+            if sent_segments is None:
+                log.warning(f"{YELLOW}[UDP] GSO unavailable on the route to {addr}, sending without it.{RESET}")
+        if sent_segments is None:
+            if _libc is not None:
+                sent_segments = _send_batched(udp_socket, addr, total_segments, thread_id)
+            else:
+                sent_segments = _send_one_by_one(udp_socket, addr, total_segments, thread_id)
+
+        # Tell the client we are done so it doesn't have to wait out its timeout
+        end_marker = PAYLOAD_HDR.pack(OFFER_MAGIC_COOKIE,
+                                      PAYLOAD_MESSAGE_TYPE,
+                                      total_segments,
+                                      END_OF_TRANSFER_SEGMENT,
+                                      thread_id)
+        for _ in range(END_OF_TRANSFER_REPEAT):
+            _sendto(udp_socket, end_marker, addr)
+
+        log.info(f"{GREEN}[UDP] Finished sending {sent_segments}/{total_segments} segments to {addr}.{RESET}")
 
     except Exception as e:
-        print(f"{RED}[UDP Error] with {addr}: {e}{RESET}")
-    finally:
-        client_socket.close()
+        log.error(f"{RED}[UDP Error] with {addr}: {e}{RESET}")
 
 def udp_server():
     """
     Listens on 'UDP_SERVER_PORT' for client requests.
-    Spawns a thread to handle each incoming request (does not close the socket per-request).
+    Runs one receive loop per CPU, each on its own SO_REUSEPORT socket.
     """
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    _run_listeners(_udp_receive_loop)
+
+
+def _udp_receive_loop(index):
+    """
+    Receives requests on one socket and hands each to the UDP worker pool (does not close the socket per-request).
+    """
+    udp_socket = _open_listener(socket.SOCK_DGRAM, UDP_SERVER_PORT, index)
 
     try:
+        _tune_sock(udp_socket)
         udp_socket.bind(("", UDP_SERVER_PORT))
-        udp_socket.settimeout(1)
-        print(f"{YELLOW}UDP Server started, listening on port {UDP_SERVER_PORT}{RESET}")
+        sel = _listen_selector(udp_socket)
+        if index == 0:
+            log.info(f"{YELLOW}UDP Server started, listening on port {UDP_SERVER_PORT} ({LISTENER_COUNT} listeners){RESET}")
 
-        while not server_shutdown_event.is_set():
-            try:
-                data, addr = udp_socket.recvfrom(2048)
-            except socket.timeout:
-                continue
+        recv_batch = _make_batch_receiver() if _libc is not None else None
 
-            threading.Thread(
-                target=handle_client_udp,
-                args=(data, addr, udp_socket),
-                daemon=True
-            ).start()
+        # Sleep until a request arrives or stop_server() is called; no periodic wake-ups
+        while not server_shutdown_event.is_set():
+            sel.select()
+            while not server_shutdown_event.is_set():
+                try:
+                    if recv_batch is not None:
+                        batch = recv_batch(udp_socket)
+                    else:
+                        batch = [udp_socket.recvfrom(REQUEST_SLOT_SIZE)]
+                except BlockingIOError:
+                    break
+                except (ConnectionResetError, ConnectionRefusedError):
+                    # An ICMP port-unreachable for a reply to a client that already left
+                    # (Windows reports it on recvfrom()); the listener itself is fine
+                    continue
+                try:
+                    for data, addr in batch:
+                        UDP_POOL.submit(handle_client_udp, data, addr, udp_socket)
+                except RuntimeError:
+                    # The pool was shut down after the check above; drop the rest of the batch
+                    break
 
     except OSError as e:
-        print(f"{RED}[UDP] Could not bind on port {UDP_SERVER_PORT}: {e}{RESET}")
+        log.error(f"{RED}[UDP] Could not bind on port {UDP_SERVER_PORT}: {e}{RESET}")
     finally:
         udp_socket.close()
 
@@ -205,10 +768,14 @@ def udp_server():
 # =============================================================================
 
 if __name__ == "__main__":
-    print(f"{GREEN}Running Server...{RESET}")
+    log_listener.start()
+    log.info(f"{GREEN}Running Server...{RESET}")
 
     server_shutdown_event.clear()
 
+    # Applies to every thread started from here on, including pool workers spawned by the listeners
+    threading.stack_size(WORKER_STACK_SIZE)
+
     # Start broadcasting offers
     t_broadcast = threading.Thread(target=udp_offer_broadcast, daemon=True)
     # Start TCP server
@@ -220,19 +787,23 @@ if __name__ == "__main__":
     t_tcp.start()
     t_udp.start()
 
-    print(f"{YELLOW}Press Ctrl+C to stop the server.{RESET}")
+    log.info(f"{YELLOW}Press Ctrl+C to stop the server.{RESET}")
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        print(f"{RED}\nStopping server...{RESET}")
+        log.info(f"{RED}\nStopping server...{RESET}")
 
     # Signal all threads to shut down
-    server_shutdown_event.set()
+    stop_server()
+    # Running handlers see the event and stop; queued ones are dropped
+    TCP_POOL.shutdown(wait=False, cancel_futures=True)
+    UDP_POOL.shutdown(wait=False, cancel_futures=True)
 
     # Optionally join threads
     t_broadcast.join()
     t_tcp.join()
     t_udp.join()
 
-    print(f"{GREEN}Server stopped.{RESET}")
+    log.info(f"{GREEN}Server stopped.{RESET}")
+    log_listener.stop()  # Flushes anything still queued